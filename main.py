@@ -1,40 +1,65 @@
+import fcntl
+import logging
+import logging.handlers
 import os
-import json
+import queue
+import random
 import threading
+import zlib
 import time
-import warnings
 from datetime import datetime
 
 import firebase_admin
 from firebase_admin import credentials, db
 
-import joblib
-import numpy as np
-
+import orjson
 from fastapi import FastAPI
+from starlette.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 
-# Suppress sklearn warnings
-warnings.filterwarnings("ignore", message="X does not have valid feature names")
+from irrigation_core import compute_irrigation_class, compute_irrigation_classes, load_model
+
+# ✅ Buffered logging: records coalesce in memory and hit stdout in batches
+# (immediately on WARNING or above) instead of one locked flush per line;
+# %-style args defer string formatting until a record is actually emitted
+# The formatter must live on the target handler: the MemoryHandler only
+# buffers records, the StreamHandler formats them at flush time
+_stream_handler = logging.StreamHandler()
+_stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+logging.basicConfig(
+    level=logging.INFO,
+    handlers=[logging.handlers.MemoryHandler(
+        capacity=256,
+        flushLevel=logging.WARNING,
+        target=_stream_handler
+    )]
+)
+log = logging.getLogger("irrigation")
 
 # ✅ Load Firebase credentials from env
 firebase_key_json = os.environ["FIREBASE_KEY_JSON"]
-firebase_cred_dict = json.loads(firebase_key_json)
+firebase_cred_dict = orjson.loads(firebase_key_json)
 
-cred = credentials.Certificate(firebase_cred_dict)
-firebase_admin.initialize_app(cred, {
-    'databaseURL': 'https://agri-hub-544be-default-rtdb.firebaseio.com'
-})
+# Guarded so forked gunicorn workers inheriting a preloaded app don't re-init
+if not firebase_admin._apps:
+    cred = credentials.Certificate(firebase_cred_dict)
+    firebase_admin.initialize_app(cred, {
+        'databaseURL': 'https://agri-hub-544be-default-rtdb.firebaseio.com'
+    })
 
-# ✅ Load model
-MODEL_PATH = "tamil_nadu_irrigation_model.pkl"
-artifacts = joblib.load(MODEL_PATH)
-model = artifacts['model']
-scaler = artifacts['scaler']
-encoders = artifacts['encoders']
+# ✅ Build the References once; db.reference() re-parses the path per call.
+# Sensor inputs and prediction outputs live under separate children so the
+# listener never sees (or re-downloads) our own writes.
+INPUTS_REF = db.reference('sensorData/inputs')
+OUTPUTS_REF = db.reference('sensorData/outputs')
 
 # ✅ FastAPI app
-app = FastAPI(title="Tamil Nadu Irrigation Prediction API", version="1.0.0")
+app = FastAPI(
+    title="Tamil Nadu Irrigation Prediction API",
+    version="1.0.0",
+    default_response_class=ORJSONResponse
+)
 
 # ✅ Data model
 class SensorData(BaseModel):
@@ -57,152 +82,258 @@ def root():
         }
     }
 
-# ✅ Prediction function (reused in both API and thread)
-def predict_irrigation(data: SensorData):
+# ✅ Firebase writes go through an in-process queue drained by one daemon
+# thread, so callers never block on write RTT. The flusher coalesces any
+# backlog and writes only the newest prediction — older ones are stale.
+_WRITE_Q = queue.Queue(maxsize=1024)
+
+def _publish_prediction(irrigation_class, timestamp):
     try:
-        now = datetime.now()
-        full_input = {
-            'soil_moisture_percent': data.soilMoisture,
-            'temperature_celsius': data.temperature,
-            'humidity_percent': data.humidity,
-            'rainfall_mm_prediction_next_1h': 0.5,
-            'hour': now.hour,
-            'day_of_year': now.timetuple().tm_yday,
-            'month': now.month,
-            'district': 'Coimbatore',
-            'zone': 'Western Zone',
-            'season': 'southwest_monsoon'
-        }
+        _WRITE_Q.put_nowait((irrigation_class, timestamp))
+    except queue.Full:
+        log.warning("Write queue full, dropping prediction write")
 
-        district_enc = encoders['le_district'].transform([full_input['district']])[0]
-        zone_enc = encoders['le_zone'].transform([full_input['zone']])[0]
-        season_enc = encoders['le_season'].transform([full_input['season']])[0]
-
-        heat_stress = int(full_input['temperature_celsius'] > 35 and full_input['humidity_percent'] < 50)
-        drought_stress = int(full_input['soil_moisture_percent'] < 30 and full_input['rainfall_mm_prediction_next_1h'] < 1)
-        soil_temp_interaction = full_input['soil_moisture_percent'] * full_input['temperature_celsius']
-        humidity_rain_interaction = full_input['humidity_percent'] * full_input['rainfall_mm_prediction_next_1h']
-
-        feature_vector = np.array([[
-            full_input['soil_moisture_percent'],
-            full_input['temperature_celsius'],
-            full_input['humidity_percent'],
-            full_input['rainfall_mm_prediction_next_1h'],
-            full_input['hour'],
-            full_input['day_of_year'],
-            full_input['month'],
-            district_enc,
-            zone_enc,
-            season_enc,
-            heat_stress,
-            drought_stress,
-            soil_temp_interaction,
-            humidity_rain_interaction
-        ]])
-
-        scaled_input = scaler.transform(feature_vector)
-        irrigation_class = int(model.predict(scaled_input)[0])
-
-        # Update Firebase with timestamp
+def _write_flusher():
+    while True:
+        irrigation_class, timestamp = _WRITE_Q.get()
+        try:
+            while True:
+                irrigation_class, timestamp = _WRITE_Q.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            OUTPUTS_REF.update({
+                'prediction_class': irrigation_class,
+                'last_prediction_time': timestamp
+            })
+            log.info("Prediction updated: class=%d at %s", irrigation_class, timestamp)
+        except Exception as e:
+            log.error("Firebase write error: %s", e)
+
+# ✅ Prediction function (reused in both API and thread); takes plain floats
+# so internal callers skip pydantic model construction entirely
+def predict_irrigation(humidity, temperature, soil_moisture, warmup=False):
+    try:
+        irrigation_class = compute_irrigation_class(soil_moisture, temperature, humidity)
+
+        if warmup:
+            return {"irrigation_class": irrigation_class, "warmup": True}
+
+        # Enqueue the Firebase publish; the response doesn't wait on RTT
         timestamp = datetime.now().isoformat()
-        db.reference('sensorData/prediction_class').set(irrigation_class)
-        db.reference('sensorData/last_prediction_time').set(timestamp)
-        
-        print(f"✅ Prediction updated: Class {irrigation_class} at {timestamp}")
+        _publish_prediction(irrigation_class, timestamp)
 
         return {"irrigation_class": irrigation_class, "timestamp": timestamp}
     except Exception as e:
-        print(f"❌ Prediction error: {str(e)}")
+        log.error("Prediction error: %s", e)
         return {"error": str(e)}
 
-# ✅ API route
+# ✅ API route — keep the prediction off the event loop: on a cache miss it
+# runs the compiled kernel (or sklearn predict for unflattened models), and
+# nogil means the threadpool thread doesn't stall other coroutines
 @app.post("/predict")
-def predict_route(data: SensorData):
-    return predict_irrigation(data)
+async def predict_route(data: SensorData):
+    return await run_in_threadpool(
+        predict_irrigation, data.humidity, data.temperature, data.soilMoisture)
+
+SENSOR_FIELDS = ('humidity', 'temperature', 'soilMoisture')
+
+# ✅ One validation + predict path for every Firebase-sourced snapshot
+# (manual trigger and polling fallback), so dedup/shortcut logic can't drift
+def _process_sensor_dict(sensor_dict):
+    if not sensor_dict:
+        return {"error": "no sensor data"}
+    try:
+        humidity = float(sensor_dict["humidity"])
+        temperature = float(sensor_dict["temperature"])
+        soil_moisture = float(sensor_dict["soilMoisture"])
+    except (KeyError, TypeError, ValueError):
+        missing = [f for f in SENSOR_FIELDS if sensor_dict.get(f) is None]
+        return {"error": f"missing or invalid sensor fields: {missing or list(SENSOR_FIELDS)}"}
+    return predict_irrigation(humidity, temperature, soil_moisture)
+
+# ✅ Cheap change detection: CRC32 of the canonical JSON instead of an
+# element-wise dict comparison (hardware crc32 on x86, then one int compare)
+def _sensor_hash(sensor_data):
+    return zlib.crc32(orjson.dumps(sensor_data, option=orjson.OPT_SORT_KEYS))
+
+# ✅ Micro-batching for listener bursts: events accumulate for a short
+# window and run through the batched kernel in one call. Only the newest
+# result is published — intermediate predictions are already stale.
+_EVENT_Q = queue.Queue(maxsize=1024)
+BATCH_WINDOW_S = 0.02
+
+def _batch_flusher():
+    while True:
+        batch = [_EVENT_Q.get()]
+        deadline = time.time() + BATCH_WINDOW_S
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(_EVENT_Q.get(timeout=remaining))
+            except queue.Empty:
+                break
+        try:
+            classes = compute_irrigation_classes(batch)
+            _publish_prediction(classes[-1], datetime.now().isoformat())
+            log.info("Batched prediction: %d event(s) -> class=%d", len(batch), classes[-1])
+        except Exception as e:
+            log.error("Batch prediction error: %s", e)
+
+# ✅ Event-driven monitoring: Firebase pushes changes over one SSE stream,
+# so there are no idle reads and change-to-prediction latency is <100ms
+def setup_firebase_listener():
+    state = {'snapshot': {}, 'last_hash': None}
+
+    def on_sensor_event(event):
+        if event.path == '/':
+            state['snapshot'] = dict(event.data) if isinstance(event.data, dict) else {}
+        else:
+            key = event.path.lstrip('/').split('/')[0]
+            state['snapshot'][key] = event.data
+            if key not in SENSOR_FIELDS:
+                return
+
+        current_sensor_data = {f: state['snapshot'].get(f) for f in SENSOR_FIELDS}
+        current_hash = _sensor_hash(current_sensor_data)
+        if current_hash == state['last_hash']:
+            return
+
+        missing_fields = [f for f in SENSOR_FIELDS if current_sensor_data[f] is None]
+        if missing_fields:
+            log.warning("Missing/null required fields: %s", missing_fields)
+            return
 
-# ✅ Improved background thread with better change detection
+        log.info("Sensor data changed: %s", current_sensor_data)
+
+        try:
+            humidity = float(current_sensor_data["humidity"])
+            temperature = float(current_sensor_data["temperature"])
+            soil_moisture = float(current_sensor_data["soilMoisture"])
+        except (ValueError, TypeError) as e:
+            log.warning("Data validation error: %s", e)
+            return
+
+        try:
+            _EVENT_Q.put_nowait((humidity, temperature, soil_moisture))
+        except queue.Full:
+            log.warning("Event queue full, dropping sensor event")
+            return
+        state['last_hash'] = current_hash
+
+    return INPUTS_REF.listen(on_sensor_event)
+
+# ✅ Polling fallback (only used if the streaming listener cannot start).
+# Adaptive cadence: poll fast right after a change (data is likely still
+# moving), back off exponentially while idle, and back off with jitter on
+# errors instead of giving up.
 def monitor_firebase_sensor_data():
-    last_sensor_values = None  # Only track sensor data, not metadata
+    last_hash = None  # CRC32 of the last processed sensor values
     consecutive_errors = 0
-    max_errors = 5
+    idle_count = 0
 
-    print("🔄 Starting Firebase monitoring...")
+    log.info("Starting Firebase polling fallback...")
 
     while True:
         try:
-            ref = db.reference("sensorData")
-            current = ref.get()
-            
+            current = INPUTS_REF.get()
+
             if current is not None:
                 # Extract only sensor data for comparison (ignore timestamps, predictions, etc.)
                 current_sensor_data = {
                     'humidity': current.get('humidity'),
-                    'temperature': current.get('temperature'), 
+                    'temperature': current.get('temperature'),
                     'soilMoisture': current.get('soilMoisture')
                 }
-                
+
                 # Check if sensor data actually changed
-                sensor_data_changed = (
-                    last_sensor_values is None or 
-                    current_sensor_data != last_sensor_values
-                )
-                
-                if sensor_data_changed:
-                    print("🔔 Detected change in SENSOR data!")
-                    print(f"   Previous sensor data: {last_sensor_values}")
-                    print(f"   Current sensor data:  {current_sensor_data}")
-                    
-                    # Validate data before processing
-                    required_fields = ['humidity', 'temperature', 'soilMoisture']
-                    if all(field in current_sensor_data and current_sensor_data[field] is not None for field in required_fields):
-                        try:
-                            data = SensorData(
-                                humidity=float(current_sensor_data["humidity"]),
-                                temperature=float(current_sensor_data["temperature"]),
-                                soilMoisture=float(current_sensor_data["soilMoisture"])
-                            )
-                            result = predict_irrigation(data)
-                            print(f"✅ Prediction result: {result}")
-                            
-                            # Update last_sensor_values after successful processing
-                            last_sensor_values = current_sensor_data.copy()
-                            consecutive_errors = 0  # Reset error counter
-                            
-                        except (ValueError, TypeError) as e:
-                            print(f"❌ Data validation error: {e}")
-                            print(f"   Raw sensor data: {current_sensor_data}")
+                current_hash = _sensor_hash(current_sensor_data)
+
+                if current_hash != last_hash:
+                    log.info("Sensor data changed: %s", current_sensor_data)
+
+                    result = _process_sensor_dict(current_sensor_data)
+                    if "error" in result:
+                        log.warning("%s; raw sensor data: %s", result['error'], current_sensor_data)
                     else:
-                        missing_fields = [f for f in required_fields if f not in current_sensor_data or current_sensor_data[f] is None]
-                        print(f"❌ Missing/null required fields: {missing_fields}")
-                        print(f"   Available sensor data: {current_sensor_data}")
-                else:
-                    print("📊 No change in sensor data (ignoring metadata updates)")
+                        log.info("Prediction result: %s", result)
+
+                    # The snapshot was processed either way; re-polling the
+                    # same (possibly invalid) values won't change the outcome
+                    last_hash = current_hash
+
+                    consecutive_errors = 0
+                    idle_count = 0
+                    time.sleep(1)
+                    continue
+
+                log.debug("No change in sensor data")
             else:
-                print("⚠️  No sensor data found in Firebase")
-                
+                log.warning("No sensor data found in Firebase")
+
+            consecutive_errors = 0
+            idle_count += 1
+            time.sleep(min(30, 2 ** min(idle_count, 5)))
+
         except Exception as e:
             consecutive_errors += 1
-            print(f"❌ Error while monitoring sensor data (attempt {consecutive_errors}): {e}")
-            
-            if consecutive_errors >= max_errors:
-                print(f"💥 Too many consecutive errors ({max_errors}). Stopping monitor.")
-                break
+            log.error("Error while monitoring sensor data (attempt %d): %s", consecutive_errors, e)
+            time.sleep(min(60, 2 ** min(consecutive_errors, 6)) + random.uniform(0, 1))
 
-        time.sleep(5)
+# ✅ Under multiple gunicorn workers only one process should run the
+# listener; a non-blocking flock decides the owner (fd held for process life)
+_monitor_lock_fd = None
+
+def _acquire_monitor_lock():
+    global _monitor_lock_fd
+    try:
+        _monitor_lock_fd = os.open("/tmp/irrigation_monitor.lock", os.O_CREAT | os.O_RDWR)
+        fcntl.flock(_monitor_lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except OSError:
+        return False
 
 # ✅ Start background monitoring
 @app.on_event("startup")
 def start_firebase_monitor():
-    print("🚀 Starting Firebase monitoring...")
-    threading.Thread(target=monitor_firebase_sensor_data, daemon=True).start()
+    # Load the model here rather than at import so gunicorn --preload can
+    # share the mmap'd arrays copy-on-write across workers, then warm up the
+    # JIT kernel and model caches so the first real request isn't penalized
+    log.info("Loading model and warming up prediction path...")
+    load_model()
+    predict_irrigation(50.0, 25.0, 40.0, warmup=True)
+
+    threading.Thread(target=_write_flusher, daemon=True).start()
+
+    if not _acquire_monitor_lock():
+        log.info("Another worker owns the Firebase monitor; serving API only")
+        return
+
+    log.info("Starting Firebase monitoring...")
+    threading.Thread(target=_batch_flusher, daemon=True).start()
+    try:
+        # Keep the registration on app.state so shutdown can close the stream
+        app.state.listener = setup_firebase_listener()
+        log.info("Firebase listener registered (event-driven)")
+    except Exception as e:
+        log.warning("Listener setup failed (%s); falling back to polling", e)
+        threading.Thread(target=monitor_firebase_sensor_data, daemon=True).start()
+
+@app.on_event("shutdown")
+def stop_firebase_monitor():
+    listener = getattr(app.state, 'listener', None)
+    if listener is not None:
+        listener.close()
+        log.info("Firebase listener closed")
 
 # ✅ Health check endpoint (fixed path consistency)
 @app.get("/health")
 def health_check():
     try:
         # Test Firebase connection - use same path as monitoring
-        test_ref = db.reference("sensorData")
-        current_data = test_ref.get()
+        current_data = INPUTS_REF.get()
         
         return {
             "status": "healthy",
@@ -218,23 +349,18 @@ def health_check():
             "timestamp": datetime.now().isoformat()
         }
 
-# ✅ Manual trigger endpoint (fixed path consistency)
+# ✅ Manual trigger endpoint (fixed path consistency); the Firebase read is
+# blocking I/O, so keep it off the event loop. The prediction itself is
+# microseconds and its write is already published in the background.
 @app.post("/trigger-prediction")
-def trigger_prediction():
+async def trigger_prediction():
     try:
-        ref = db.reference("sensorData")  # Use consistent path
-        current_data = ref.get()
-        
-        if current_data and all(field in current_data for field in ['humidity', 'temperature', 'soilMoisture']):
-            data = SensorData(
-                humidity=float(current_data.get("humidity", 0.0)),
-                temperature=float(current_data.get("temperature", 0.0)),
-                soilMoisture=float(current_data.get("soilMoisture", 0.0))
-            )
-            result = predict_irrigation(data)
-            return {"status": "success", "result": result, "input_data": current_data}
-        else:
-            return {"status": "error", "message": "No valid sensor data found"}
+        current_data = await run_in_threadpool(INPUTS_REF.get)
+
+        result = _process_sensor_dict(current_data)
+        if "error" in result:
+            return {"status": "error", "message": result["error"]}
+        return {"status": "success", "result": result, "input_data": current_data}
             
     except Exception as e:
         return {"status": "error", "message": str(e)}